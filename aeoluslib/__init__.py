@@ -27,9 +27,13 @@ import errno
 import logging
 import tempfile
 import shlex
-import json
-import urlparse, urlgrabber
-from rpmUtils.miscutils import splitFilename
+import time
+import threading
+import urlparse
+from rpmUtils.miscutils import splitFilename, compareEVR, stringToVersion
+from aeoluslib.jobserver import CpuBudget
+from aeoluslib.buildroot import Buildroot
+from aeoluslib.specfile import parse_specs, target_macros, normalize_deps
 
 # Module-wide support for specifying a working directory
 workdir = None
@@ -39,6 +43,24 @@ workdir = None
 # responsible for removing any repofiles created
 cleanup = True
 
+# Module-wide CPU budget shared by all builds.  When None, a budget covering
+# every online core is created on first use (see get_cpu_budget())
+cpu_budget = None
+
+# Module-wide support for building inside isolated buildroots.  When
+# isolated=True, BuildRequires are installed into a cached chroot snapshot
+# rather than onto the host
+isolated = False
+
+# Module-wide support for cloning from mirrors.  When set, each module's
+# git_url is replaced by <scm_baseurl>/<basename of git_url>
+scm_baseurl = None
+
+# Module-wide target used to evaluate .spec conditionals.  When None, the
+# %{dist} and architecture of the running system are used
+target_dist = None
+target_arch = None
+
 class AeolusModule(object):
     def __init__(self, **kwargs):
         # Module name (defaults to __class__.__name__.lower())
@@ -49,10 +71,24 @@ class AeolusModule(object):
         if not hasattr(self, 'git_url') or self.git_url is None:
             raise Exception("Module %s has no git_url defined" % self.__class__.__name__)
 
+        if scm_baseurl is not None:
+            self.git_url = '%s/%s' % (scm_baseurl.rstrip('/'),
+                os.path.basename(self.git_url))
+
+        # Names of other modules this module builds or runs against
+        if not hasattr(self, 'depends_on'):
+            self.depends_on = list()
+
         # Shell command needed to build RPMs from SCM
         if not hasattr(self, 'package_cmd'):
             self.package_cmd = 'make rpms'
 
+        # Independent build sub-targets, as a list of (directory, command)
+        # tuples relative to the checkout.  When defined, the sub-targets are
+        # built concurrently and package_cmd is not used.
+        if not hasattr(self, 'build_targets'):
+            self.build_targets = list()
+
         # Shell command needed to run built-in unittests from SCM
         if not hasattr(self, 'unittest_cmd'):
             self.unittest_cmd = 'make test'
@@ -73,6 +109,9 @@ class AeolusModule(object):
         else:
             self.workdir = tempfile.mkdtemp(suffix='.%s' % self.name)
 
+        # Isolated buildroot in use by the current build (if any)
+        self.buildroot = None
+
     def setup(self):
         raise NotImplementedError("Not implemented by derived class")
 
@@ -126,35 +165,23 @@ class AeolusModule(object):
         '''
 
         assert deptype in ['BuildRequires', 'Requires'], \
-            "Unknown dependency type requested: " % deptype
+            "Unknown dependency type requested: %s" % deptype
 
-        # Find any files that look like .spec files
+        # Find any .spec files (or autoconf .spec.in templates)
         specfiles = list()
         for root, dirs, files in os.walk(self.workdir):
+            if '.git' in dirs:
+                dirs.remove('.git')
             specfiles += [os.path.join(root, spec) for spec in files \
-                            if '.spec' in spec]
+                            if spec.endswith('.spec') or spec.endswith('.spec.in')]
 
         if len(specfiles) <= 0:
             logging.warn("No .spec files found")
 
-        deps = list()
-        # Gather any 'BuildRequires' from the spec files
-        for spec in specfiles:
-            # TODO - instead of pattern matching for requirements, use
-            # rpmspec.  Note, rpmspec is not included in RHEL6 at this time.
-            #  rpmspec -q --requires /path/to/rpm.spec
-            #  rpmspec -q --buildrequires /path/to/rpm.spec
-            for br in re.findall(r'^%s:\s+(.*)$' % deptype, \
-               open(spec, 'r').read(), re.MULTILINE):
-                # If this is a versioned compare, only split by comma
-                if re.search(r'[<>=]', br):
-                    deps += re.split(r'\s*,\s*', br)
-                # Otherwise, split by comma or whitespace
-                else:
-                    deps += re.split(r'[ ,]*', br)
-
-        # Remove any duplicates
-        return list(set(deps))
+        # TODO - use rpmspec once available.  Note, rpmspec is not included
+        # in RHEL6 at this time.
+        return parse_specs(specfiles, deptype,
+            target_macros(target_dist, target_arch))
 
     def _install_reqs(self):
         runtime_reqs = self._detect_requires()
@@ -182,6 +209,27 @@ class AeolusModule(object):
                 (self.name, ', '.join(self.build_requires)))
             yum_install_if_needed(self.build_requires)
 
+    def _setup_buildroot(self):
+        '''Prepare an isolated buildroot providing all BuildRequires'''
+        deps = self.build_requires + self._detect_buildreqs()
+        logging.info("BuildRequires for %s: %s" % (self.name, ', '.join(deps)))
+
+        packages = list()
+        for dep in deps:
+            pkgs = yum_resolvedep(dep)
+            if len(pkgs) == 0:
+                logging.warn("No package satisfies dependency: %s" % dep)
+            packages += pkgs
+
+        self.buildroot = Buildroot(packages)
+        self.buildroot.setup(self.workdir)
+
+    def _call(self, cmd, raiseExc=True, cwd=None, env=None):
+        '''Run a build command, inside the buildroot when one is in use'''
+        if self.buildroot is not None:
+            return self.buildroot.call(cmd, raiseExc, cwd=cwd, env=env)
+        return call(cmd, raiseExc, cwd=cwd, env=env)
+
     def is_installed(self):
         '''install package via RPM'''
         logging.info("Checking if %s is installed" % self.name)
@@ -266,19 +314,19 @@ class AeolusModule(object):
                 os.chdir(cwd)
         return rc
 
-    def _make_rpms(self):
-        '''Runs self.package_cmd and returns a list of built packages'''
+    def _make_rpms(self, targets=None):
+        '''Runs self.package_cmd (or the requested build_targets) and returns
+        a list of built packages'''
+        if len(self.build_targets) > 0:
+            return self._make_target_rpms(targets)
+
         logging.info("Building %s RPM packages" % self.name)
 
-        cwd = os.getcwd()
-        build_log = ''
-        try:
-            os.chdir(self.workdir)
-            (rc, build_log) = call(self.package_cmd)
-        finally:
-            # return to old directory
-            if os.getcwd() != cwd:
-                os.chdir(cwd)
+        start = time.time()
+        with get_cpu_budget().allocate(self.name) as env:
+            (rc, build_log) = self._call(self.package_cmd, cwd=self.workdir,
+                env=env)
+        logging.info("Built %s in %.1fs" % (self.name, time.time() - start))
 
         # Return a list of package paths (includes src.rpm)
         packages_built = re.findall("^Wrote:\s*(.*\.rpm)$", build_log, re.MULTILINE)
@@ -290,13 +338,126 @@ class AeolusModule(object):
 
         return packages_built
 
-    def build_from_scm(self):
+    def _select_build_targets(self, targets=None):
+        '''Return the (directory, command) build_targets matching the
+        requested list of directories (default: all)'''
+        if targets is None:
+            return list(self.build_targets)
+
+        known = [d for (d, cmd) in self.build_targets]
+        for t in targets:
+            if t not in known:
+                raise Exception("Unknown build target for %s: %s" % \
+                    (self.name, t))
+        return [(d, cmd) for (d, cmd) in self.build_targets if d in targets]
+
+    def changed_build_targets(self, old_hash, new_hash='HEAD'):
+        '''Return the build_targets directories containing files changed
+        between the two provided commits.  Every directory is returned when
+        a file outside all of them changed (e.g. a shared Makefile or lib),
+        since it may affect any target.'''
+        (rc, out) = call('git diff --name-only %s %s' % (old_hash, new_hash),
+            cwd=self.workdir)
+        changed = [f for f in out.split('\n') if f != '']
+        prefixes = [d.rstrip('/') + '/' for (d, cmd) in self.build_targets]
+        outside = [f for f in changed \
+                   if not [p for p in prefixes if f.startswith(p)]]
+        if len(outside) > 0:
+            logging.info("Rebuilding all targets of %s, " % self.name \
+                + "files outside them changed: %s" % ', '.join(outside))
+            return [d for (d, cmd) in self.build_targets]
+        return [d for (d, cmd) in self.build_targets \
+                if [f for f in changed if f.startswith(d.rstrip('/') + '/')]]
+
+    def _make_target_rpms(self, targets=None):
+        '''Build the requested build_targets concurrently and return a
+        merged list of built packages'''
+        selected = self._select_build_targets(targets)
+        if len(selected) == 0:
+            logging.warn("No build targets selected for %s" % self.name)
+            return list()
+
+        logging.info("Building %s RPM packages (%s)" % (self.name,
+            ', '.join([d for (d, cmd) in selected])))
+
+        # Split the budget evenly between the sub-targets
+        budget = get_cpu_budget()
+        share = max(1, budget.total / len(selected))
+
+        results = dict()
+        def _build(directory, cmd):
+            start = time.time()
+            with budget.allocate('%s:%s' % (self.name, directory), share) as env:
+                (rc, out) = self._call(cmd, raiseExc=False,
+                    cwd=os.path.join(self.workdir, directory), env=env)
+            results[directory] = (rc, out, time.time() - start)
+
+        threads = [threading.Thread(target=_build, args=t) for t in selected]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        packages_built = list()
+        failed = list()
+        for (directory, cmd) in selected:
+            (rc, out, elapsed) = results.get(directory, (-1, '', 0))
+
+            # Keep a separate log for each target
+            logfile = os.path.join(self.workdir, '%s.build.log' % \
+                directory.strip('/').replace('/', '_'))
+            fd = open(logfile, 'w')
+            try:
+                fd.write(out)
+            finally:
+                fd.close()
+
+            pkgs = re.findall("^Wrote:\s*(.*\.rpm)$", out, re.MULTILINE)
+            logging.info("Built %s:%s in %.1fs, rc=%s (log: %s)" % \
+                (self.name, directory, elapsed, rc, logfile))
+            if rc != 0 or len(pkgs) == 0:
+                failed.append(directory)
+            for pkg in pkgs:
+                logging.info("... %s" % pkg)
+            packages_built += pkgs
+
+        if len(failed) > 0:
+            raise Exception("Failed to build %s targets: %s, consult build logs" \
+                % (self.name, ', '.join(failed)))
+
+        return packages_built
+
+    def _export_packages(self, packages):
+        '''Copy packages written outside of self.workdir out of the
+        buildroot, returning their new paths'''
+        exported = list()
+        rpmdir = os.path.join(self.workdir, 'rpms')
+        for pkg in packages:
+            if pkg.startswith(self.workdir.rstrip('/') + '/'):
+                exported.append(pkg)
+            else:
+                makedirs(rpmdir)
+                dest = os.path.join(rpmdir, os.path.basename(pkg))
+                shutil.copy(self.buildroot.host_path(pkg), dest)
+                exported.append(dest)
+        return exported
+
+    def build_from_scm(self, targets=None):
         self._clone_from_scm()
-        self._install_buildreqs()
-        return self._make_rpms()
+        if not isolated:
+            self._install_buildreqs()
+            return self._make_rpms(targets)
 
-    def install_from_scm(self, force=False):
-        packages = self.build_from_scm()
+        try:
+            self._setup_buildroot()
+            return self._export_packages(self._make_rpms(targets))
+        finally:
+            if self.buildroot is not None:
+                self.buildroot.teardown()
+                self.buildroot = None
+
+    def install_from_scm(self, force=False, targets=None):
+        packages = self.build_from_scm(targets)
 
         # Strip out any .src.rpm files
         non_src_pkgs  = [p for p in packages if splitFilename(p)[4] != 'src']
@@ -318,26 +479,23 @@ class AeolusModule(object):
         assert isinstance(branch, str), "branch argument must be a string"
 
         u = urlparse.urlparse(self.git_url)
-        if u.scheme == 'git':
-            if u.netloc == 'github.com':
-                # Formulate API call
-                json_url = "http://%s/api/v2/json/repos/show%s/branches" \
-                    % (u.netloc, re.sub(r'\.git$', '', u.path))
-                json_data = json.loads(urlgrabber.urlopen(json_url).read())
-                if isinstance(json_data, dict):
-                    return json_data.get('branches', {}).get(branch, 'UNKNOWN')
-                else:
-                    logging.error("Unknown json data format: %s" % type(json_data))
+        # Local repositories have no scheme (or file://)
+        if u.scheme in ['git', 'file', '']:
+            (rc, out) = call("git ls-remote %s refs/heads/%s" % (self.git_url,
+                branch), raiseExc=False)
+            out = out.strip() # yank off newline char
+            if rc == 0 and out != '':
+                return out.split()[0]
             else:
-                (rc, out) = call("git ls-remote %s refs/heads/%s" % (self.git_url, branch))
-                if rc == 0:
-                    out = out.strip() # yank off newline char
-                    return out.split()[0]
-                else:
-                    logging.error("Unable to query repository: %s" % u)
+                logging.error("Unable to query repository: %s" % self.git_url)
         else:
             logging.error("Unhandled SCM format: %s" % u.scheme)
 
+    def get_local_hash(self):
+        '''Return the git-hash of the checked out commit'''
+        (rc, out) = call('git rev-parse HEAD', cwd=self.workdir)
+        return out.strip()
+
 
 class Conductor (AeolusModule):
     name = 'aeolus-conductor'
@@ -362,6 +520,7 @@ class Conductor (AeolusModule):
 class Configure (AeolusModule):
     name = 'aeolus-configure'
     git_url = 'git://github.com/aeolusproject/aeolus-configure.git'
+    depends_on = ['aeolus-conductor', 'imagefactory', 'iwhd']
     package_cmd = 'rake rpms'
 
     def uninstall(self):
@@ -393,6 +552,7 @@ class Oz (AeolusModule):
 
 class Imagefactory (AeolusModule):
     git_url = 'git://github.com/aeolusproject/imagefactory.git'
+    depends_on = ['oz']
     package_cmd = 'make rpm'
 
 class Iwhd (AeolusModule):
@@ -403,8 +563,8 @@ class Audrey (AeolusModule):
     #name = 'aeolus-configserver'
     git_url = 'git://github.com/aeolusproject/audrey.git'
     unittest_cmd = 'python audrey_start/test_audrey_startup.py'
-    package_cmd = 'cd agent && make rpms && cd .. && ' \
-                + 'cd configserver && rake rpm'
+    build_targets = [('agent', 'make rpms'),
+                     ('configserver', 'rake rpm')]
 
 class Libdeltacloud (AeolusModule):
     git_url = 'git://git.fedorahosted.org/deltacloud/libdeltacloud.git'
@@ -413,6 +573,7 @@ class Libdeltacloud (AeolusModule):
 class PacemakerCloud (AeolusModule):
     name = 'pacemaker-cloud'
     git_url = 'git://github.com/pacemaker-cloud/pacemaker-cloud.git'
+    depends_on = ['libdeltacloud']
     package_cmd = './autogen.sh && ./configure && make rpm'
 
 # No longer required upstream
@@ -428,11 +589,13 @@ class PacemakerCloud (AeolusModule):
 
 class Katello (AeolusModule):
     git_url = 'git://git.fedorahosted.org/git/katello.git'
+    depends_on = ['pulp', 'candlepin']
     # FIXME - add support for handling provides: rubygem(compass) >= 0.11.5
     package_cmd = 'cd src && tito build --rpm --test'
 
 class Pulp (AeolusModule):
     git_url = 'git://git.fedorahosted.org/pulp.git'
+    depends_on = ['gofer']
     package_cmd = 'tito build --rpm --test'
 
 class Candlepin (AeolusModule):
@@ -482,31 +645,149 @@ def yum_install_if_needed(dependencies):
             logging.debug('Installed package %s satisfies dependency: %s' % (out, dep))
         else:
             logging.debug('Checking yum repos to satisfy dependency: %s' % dep)
-            # Is the dependency satisfied by packages in the repos?
-            (rc, out) = call('yum --quiet resolvedep "%s"' % dep, raiseExc=False)
-            if rc != 0:
+            pkgs = yum_resolvedep(dep)
+            if len(pkgs) == 0:
                 # FIXME - should this be considered fatal?
                 logging.warn("No package satisfies dependency: %s" % dep)
-            else:
-                # scan output to find a match ... yes this is not ideal and
-                # would be better handled through some yum API
-                found = False
-                for line in out.split('\n'):
-                    if re.match(r'^\d+:[^\s]+$', line):
-                        # expected output format from /usr/share/yum-cli/cli.py
-                        # resolveDepCli() '%s:%s-%s-%s.%s' % (pkg.epoch,
-                        # pkg.name, pkg.version, pkg.release, pkg.arch) strip off
-                        # the 'epoch:'
-                        pkg = line.split(':', 1)[1].strip()
-                        missing_pkgs.append(pkg)
-                        found = True
-                if not found:
-                    logging.warn("No package satisfies dependency: %s" % dep)
+            missing_pkgs += pkgs
 
     if len(missing_pkgs) > 0:
         logging.info("Installing packages: %s" % ' '.join(missing_pkgs))
         yum_install(missing_pkgs)
 
+def compare_versions(v1, v2):
+    '''Compare two [epoch:]version[-release] strings like rpm does.  When
+    either release is missing, only epoch and version are compared.'''
+    (e1, ver1, r1) = stringToVersion(v1)
+    (e2, ver2, r2) = stringToVersion(v2)
+    if r1 is None or r2 is None:
+        r1 = r2 = None
+    return compareEVR((e1, ver1, r1), (e2, ver2, r2))
+
+def _merge_constraints(name, constraints):
+    '''Merge the (op, version) constraints on a single package into the
+    smallest equivalent list of deps.  Returns None if they conflict.'''
+    exact = None
+    lower = None    # (op, version) of the strongest '>' or '>='
+    upper = None    # (op, version) of the strongest '<' or '<='
+    for (op, ver) in constraints:
+        if op is None:
+            continue
+        if op == '=':
+            if exact is not None and compare_versions(exact, ver) != 0:
+                return None
+            # Prefer the more specific of two equivalent versions
+            if exact is None or len(ver) > len(exact):
+                exact = ver
+        elif op in ['>', '>=']:
+            if lower is None:
+                lower = (op, ver)
+                continue
+            c = compare_versions(ver, lower[1])
+            if c > 0 or (c == 0 and op == '>'):
+                lower = (op, ver)
+        elif op in ['<', '<=']:
+            if upper is None:
+                upper = (op, ver)
+                continue
+            c = compare_versions(ver, upper[1])
+            if c < 0 or (c == 0 and op == '<'):
+                upper = (op, ver)
+
+    if lower is not None and upper is not None:
+        c = compare_versions(lower[1], upper[1])
+        if c > 0 or (c == 0 and (lower[0] == '>' or upper[0] == '<')):
+            return None
+
+    if exact is not None:
+        if lower is not None:
+            c = compare_versions(exact, lower[1])
+            if c < 0 or (c == 0 and lower[0] == '>'):
+                return None
+        if upper is not None:
+            c = compare_versions(exact, upper[1])
+            if c > 0 or (c == 0 and upper[0] == '<'):
+                return None
+        return ['%s = %s' % (name, exact)]
+
+    merged = ['%s %s %s' % (name, c[0], c[1]) for c in [lower, upper] \
+              if c is not None]
+    return merged or [name]
+
+def consolidate_dependencies(requested):
+    '''Merge the dependencies requested by several modules, provided as a
+    dict of module -> list of deps.  Returns a tuple of ...
+        1) the merged list of deps
+        2) a dict of package name -> modules requesting it
+        3) a dict of conflicting package name -> {dep: modules}
+    '''
+    order = list()
+    owners = dict()
+    constraints = dict()
+    for module in sorted(requested.keys()):
+        for dep in normalize_deps(' , '.join(requested[module])):
+            parts = dep.split()
+            name = parts[0]
+            if name not in owners:
+                order.append(name)
+                owners[name] = list()
+                constraints[name] = dict()
+            if module not in owners[name]:
+                owners[name].append(module)
+            key = len(parts) == 3 and (parts[1], parts[2]) or (None, None)
+            constraints[name].setdefault(key, list())
+            if module not in constraints[name][key]:
+                constraints[name][key].append(module)
+
+    deps = list()
+    conflicts = dict()
+    for name in order:
+        merged = _merge_constraints(name, constraints[name].keys())
+        if merged is None:
+            conflicts[name] = dict(((op is None and name or \
+                '%s %s %s' % (name, op, ver)), mods) \
+                for ((op, ver), mods) in constraints[name].items())
+        else:
+            deps += merged
+    return (deps, owners, conflicts)
+
+def install_consolidated(requested, deptype='Requires'):
+    '''Install the union of the dependencies requested by several modules
+    (dict of module -> list of deps) in a single yum transaction.  Returns
+    False if any requested versions conflict.'''
+    (deps, owners, conflicts) = consolidate_dependencies(requested)
+
+    logging.info("%s for %s (%d packages):" % (deptype,
+        ', '.join(sorted(requested.keys())), len(owners)))
+    for dep in deps:
+        logging.info("... %s <- %s" % (dep, ', '.join(owners[dep.split()[0]])))
+
+    for name in sorted(conflicts.keys()):
+        logging.error("Conflicting %s for %s, not installed:" % (deptype, name))
+        for (dep, mods) in sorted(conflicts[name].items()):
+            logging.error("... %s <- %s" % (dep, ', '.join(mods)))
+
+    yum_install_if_needed(deps)
+    return len(conflicts) == 0
+
+def yum_resolvedep(dep):
+    '''Return the list of packages (name-version-release.arch) from the
+    configured repos that satisfy the provided dependency'''
+    pkgs = list()
+    # Is the dependency satisfied by packages in the repos?
+    (rc, out) = call('yum --quiet resolvedep "%s"' % dep, raiseExc=False)
+    if rc == 0:
+        # scan output to find a match ... yes this is not ideal and
+        # would be better handled through some yum API
+        for line in out.split('\n'):
+            if re.match(r'^\d+:[^\s]+$', line):
+                # expected output format from /usr/share/yum-cli/cli.py
+                # resolveDepCli() '%s:%s-%s-%s.%s' % (pkg.epoch,
+                # pkg.name, pkg.version, pkg.release, pkg.arch) strip off
+                # the 'epoch:'
+                pkgs.append(line.split(':', 1)[1].strip())
+    return pkgs
+
 def yum_install(packages, gpgcheck=False):
 
     assert isinstance(packages, list), \
@@ -549,10 +830,20 @@ def makedirs(path):
         if e.errno == errno.EEXIST:
             pass
 
-def call(cmd, raiseExc=True):
+def get_cpu_budget():
+    '''Return the module-wide CpuBudget, creating a default one if needed'''
+    global cpu_budget
+    if cpu_budget is None:
+        cpu_budget = CpuBudget()
+    return cpu_budget
+
+def call(cmd, raiseExc=True, cwd=None, env=None):
     logging.debug(cmd)
+    # Any provided env supplements (rather than replaces) os.environ
+    if env is not None:
+        env = dict(os.environ, **env)
     p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
+            stderr=subprocess.STDOUT, cwd=cwd, env=env)
     (pout, perr) = p.communicate()
     logging.debug("rc: %s" %  p.returncode)
     logging.debug("output: %s" %  pout)
@@ -0,0 +1,215 @@
+#
+# Build modules inside isolated chroots restored from cached snapshots
+#
+# Copyright (C) 2011  Red Hat
+# James Laska <jlaska@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import time
+import shutil
+import logging
+import tempfile
+import hashlib
+import pipes
+
+import aeoluslib
+
+# Where buildroot snapshots are kept between runs
+snapshot_dir = '/var/cache/aeolus-helper/buildroots'
+
+# Snapshots unused for this many days are removed
+snapshot_max_age = 14
+
+# Only the most recently used snapshots are kept beyond this number
+snapshot_max_count = 8
+
+# Packages present in every buildroot, regardless of BuildRequires
+base_packages = ['bash', 'coreutils', 'findutils', 'sed', 'gawk', 'grep',
+    'tar', 'gzip', 'bzip2', 'patch', 'which', 'git', 'make', 'gcc',
+    'gcc-c++', 'rpm-build', 'redhat-rpm-config', 'rubygem-rake', 'tito']
+
+# Host paths bind-mounted into every buildroot
+bind_mounts = ['/proc', '/sys', '/dev']
+
+class Buildroot(object):
+    '''A chroot populated from a snapshot keyed by its package set.
+
+    The first buildroot needing a given set of packages creates the snapshot
+    with yum --installroot.  Every later buildroot with the same set is
+    restored from the snapshot using a copy-on-write (reflink) copy, or a
+    plain copy where the filesystem doesn't support reflinks.  Hardlinks are
+    never used: builds (and rpm itself) modify files of the root in place,
+    which would rewrite the shared snapshot.
+
+    Each use refreshes the snapshot's modification time, and creating a
+    snapshot prunes the least recently used ones (see prune_snapshots()).
+    '''
+
+    def __init__(self, packages, cachedir=None):
+        self.packages = sorted(set(base_packages + list(packages)))
+        self.key = hashlib.sha1('\n'.join(self.packages)).hexdigest()
+        if cachedir is None:
+            cachedir = snapshot_dir
+        self.cachedir = cachedir
+        self.snapshot = os.path.join(cachedir, self.key)
+        # Roots live next to the snapshots, since reflinks can't cross
+        # filesystems
+        self.rootdir = os.path.join(os.path.dirname(cachedir.rstrip('/')),
+            'roots')
+        self.root = None
+        self.mounts = list()
+
+    def _create_snapshot(self):
+        '''Install self.packages into a new snapshot'''
+        aeoluslib.makedirs(self.cachedir)
+        tmproot = tempfile.mkdtemp(prefix='.%s.' % self.key, dir=self.cachedir)
+        logging.info("Creating buildroot snapshot %s (%d packages)" % \
+            (self.key, len(self.packages)))
+        try:
+            (rc, out) = aeoluslib.call("rpm -q --qf '%{version}\\n' " \
+                + "--whatprovides redhat-release")
+            releasever = out.strip().split('\n')[0]
+            aeoluslib.call('yum --nogpgcheck --installroot=%s --releasever=%s ' \
+                % (tmproot, releasever) + '-y install %s' % \
+                ' '.join([pipes.quote(p) for p in self.packages]))
+            # Another build may have created the same snapshot meanwhile
+            if os.path.isdir(self.snapshot):
+                shutil.rmtree(tmproot)
+            else:
+                os.rename(tmproot, self.snapshot)
+        except:
+            shutil.rmtree(tmproot, ignore_errors=True)
+            raise
+        prune_snapshots(self.cachedir, keep=[self.key])
+
+    def setup(self, workdir):
+        '''Restore the snapshot into a new root and make workdir available
+        inside it at the same path'''
+        if os.path.isdir(self.snapshot):
+            logging.info("Reusing buildroot snapshot %s" % self.key)
+        else:
+            self._create_snapshot()
+        # The modification time records when the snapshot was last used
+        os.utime(self.snapshot, None)
+
+        aeoluslib.makedirs(self.rootdir)
+        self.root = tempfile.mkdtemp(prefix='aeolus-buildroot.',
+            dir=self.rootdir)
+        try:
+            (rc, out) = aeoluslib.call('cp -a --reflink=always %s/. %s/' % \
+                (self.snapshot, self.root), raiseExc=False)
+            if rc != 0:
+                # A failed reflink copy leaves empty files behind, start over
+                logging.debug("Reflink copy unsupported, copying snapshot")
+                shutil.rmtree(self.root, ignore_errors=True)
+                self.root = tempfile.mkdtemp(prefix='aeolus-buildroot.',
+                    dir=self.rootdir)
+                aeoluslib.call('cp -a %s/. %s/' % (self.snapshot, self.root))
+
+            # Allow network access from within the root (tito, rake).  The
+            # file is replaced rather than rewritten in place.
+            if os.path.isfile('/etc/resolv.conf'):
+                resolv_conf = self.host_path('/etc/resolv.conf')
+                if os.path.lexists(resolv_conf):
+                    os.unlink(resolv_conf)
+                shutil.copy('/etc/resolv.conf', resolv_conf)
+
+            for path in bind_mounts + [workdir]:
+                self._bind_mount(path)
+        except:
+            # Don't leave host directories mounted under a stray root
+            self.teardown()
+            raise
+
+    def _bind_mount(self, path):
+        target = self.host_path(path)
+        aeoluslib.makedirs(target)
+        aeoluslib.call('mount --bind %s %s' % (path, target))
+        self.mounts.append(target)
+
+    def teardown(self):
+        '''Unmount everything and remove the root'''
+        if self.root is None:
+            return
+
+        busy = list()
+        while len(self.mounts) > 0:
+            target = self.mounts.pop()
+            (rc, out) = aeoluslib.call('umount %s' % target, raiseExc=False)
+            if rc != 0:
+                busy.append(target)
+
+        # Never remove a root that still has host directories mounted in it
+        if len(busy) > 0:
+            logging.error("Unable to unmount %s, leaving buildroot %s" % \
+                (', '.join(busy), self.root))
+        else:
+            shutil.rmtree(self.root, ignore_errors=True)
+        self.root = None
+
+    def host_path(self, path):
+        '''Return the host path of a path inside the root'''
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def call(self, cmd, raiseExc=True, cwd=None, env=None):
+        '''Run a shell command inside the root'''
+        if cwd is not None:
+            cmd = 'cd %s && %s' % (pipes.quote(cwd), cmd)
+        return aeoluslib.call('chroot %s /bin/sh -c %s' % (self.root,
+            pipes.quote(cmd)), raiseExc, env=env)
+
+def prune_snapshots(cachedir=None, keep=[], max_age=None, max_count=None):
+    '''Remove the snapshots unused for max_age days, then the least recently
+    used ones beyond max_count, along with any snapshot left half-created.
+    Snapshots named in keep are never removed.  Returns the keys removed.'''
+    if cachedir is None:
+        cachedir = snapshot_dir
+    if max_age is None:
+        max_age = snapshot_max_age
+    if max_count is None:
+        max_count = snapshot_max_count
+    if not os.path.isdir(cachedir):
+        return list()
+
+    now = time.time()
+    snapshots = list()
+    removed = list()
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        if not os.path.isdir(path):
+            continue
+        mtime = os.path.getmtime(path)
+        # Temporary roots of an interrupted _create_snapshot()
+        if name.startswith('.'):
+            if now - mtime > 86400:
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        if not re.match(r'^[0-9a-f]{40}$', name) or name in keep:
+            continue
+        snapshots.append((mtime, name))
+
+    # Most recently used first
+    snapshots.sort(reverse=True)
+    room = max(0, max_count - len(keep))
+    for (index, (mtime, name)) in enumerate(snapshots):
+        if index >= room or now - mtime > max_age * 86400:
+            logging.info("Removing buildroot snapshot %s (last used %s)" % \
+                (name, time.ctime(mtime)))
+            shutil.rmtree(os.path.join(cachedir, name), ignore_errors=True)
+            removed.append(name)
+    return removed
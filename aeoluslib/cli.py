@@ -28,7 +28,8 @@ command_list = ['list-requires', 'list-buildrequires',
                 'install',
                 'build',
                 'ls-remote',
-                'unittest']
+                'unittest',
+                'watch']
 
 try:
     import aeoluslib
@@ -94,7 +95,9 @@ Examples:
  * Install audrey using yum
    $ aeolus-helper --source=yum install audrey
  * Install everything from git
-   $ aeolus-helper --source=git install all''' % \
+   $ aeolus-helper --source=git install all
+ * Rebuild everything whenever upstream changes
+   $ aeolus-helper --basedir=/var/tmp/aeolus --no-clean watch all''' % \
     (textwrap.fill(', '.join(command_list), parser.formatter.width, subsequent_indent=' '),
      textwrap.fill(', '.join(component_list), parser.formatter.width, subsequent_indent=' '),)
 
@@ -114,6 +117,43 @@ Examples:
         default=None, help="Log output to a file")
     parser.add_option("--no-clean", action="store_true", dest="no_clean",
         default=False, help="Don't cleanup after completion",)
+    parser.add_option("-t", "--target", action="append", dest="targets",
+        default=None, help="Only build the named sub-target directory of " + \
+            "modules defining build_targets (may be repeated)")
+    parser.add_option("-j", "--jobs", action="store", type="int",
+        dest="jobs", default=None,
+        help="Number of cores shared by all builds on this host " + \
+            "(default: all online cores)")
+    parser.add_option("--jobserver", action="store_true", dest="jobserver",
+        default=False, help="Share a single GNU make jobserver token pool " + \
+            "between all builds")
+    parser.add_option("--isolated", action="store_true", dest="isolated",
+        default=False, help="Build inside a chroot restored from a cached " + \
+            "snapshot of its BuildRequires, rather than on the host")
+    parser.add_option("--scm-baseurl", action="store", dest="scm_baseurl",
+        default=None, help="Clone every module from <scm_baseurl>/<repo>.git " + \
+            "rather than its upstream git_url (e.g. a directory of bare repos)")
+    parser.add_option("--interval", action="store", type="int",
+        dest="interval", default=300,
+        help="Seconds between polls of upstream branches when using " + \
+            "'watch' (default: %default)")
+    parser.add_option("--debounce", action="store", type="int",
+        dest="debounce", default=60,
+        help="Seconds a changed branch must remain unchanged before " + \
+            "'watch' rebuilds it (default: %default)")
+    parser.add_option("--state-file", action="store", dest="statefile",
+        default='/var/cache/aeolus-helper/watch.json',
+        help="File recording the last commit built by 'watch' (default: %default)")
+    parser.add_option("--dist", action="store", dest="dist", default=None,
+        help="Target %{dist} used to evaluate .spec conditionals, " + \
+            "e.g. .el6 (default: that of this system)")
+    parser.add_option("--arch", action="store", dest="arch", default=None,
+        help="Target architecture used to evaluate .spec conditionals " + \
+            "(default: that of this system)")
+    parser.add_option("--no-consolidate", action="store_false",
+        dest="consolidate", default=True,
+        help="With install-requires/install-buildrequires, install the " + \
+            "requirements of each module in a separate yum transaction")
     parser.add_option("-d", "--debug", action="store_true", dest="debug",)
     parser.add_option("-f", "--force-install", action="store_true", dest="rpmforce",
         default=False, help="install packages w/ rpm --force rather than yum",)
@@ -0,0 +1,217 @@
+#
+# Share a host-wide CPU budget between concurrent module builds
+#
+# Copyright (C) 2011  Red Hat
+# James Laska <jlaska@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+import errno
+import fcntl
+import logging
+import tempfile
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+# Directory holding one lock file per core, shared by every aeolus-helper
+# process on the host
+slot_dir = '/var/run/aeolus-helper/cpu'
+
+class CpuBudget(object):
+    '''Hand out shares of a fixed number of cores to concurrent builds.
+
+    Cores are host-wide: each one is a lock file in slot_dir, held with
+    flock() for the duration of a build, so concurrent aeolus-helper
+    processes (e.g. a 'watch' daemon and a manual 'build') share the same
+    budget.  The kernel drops the locks of a process that dies.  Every
+    process should use the same number of jobs.
+
+    Each build is told about its share through MAKEFLAGS (-jN) and
+    RPM_BUILD_NCPUS (used by rpm's %_smp_mflags).  Optionally, a GNU make
+    compatible jobserver pipe is exported so that every make process,
+    across all builds, draws from a single token pool.  Each build adds
+    one token less than its share to the pool, since its top-level make
+    holds an implicit token.
+    '''
+
+    def __init__(self, jobs=None, jobserver=False, slotdir=None):
+        if jobs is None or jobs <= 0:
+            try:
+                jobs = multiprocessing.cpu_count()
+            except NotImplementedError:
+                jobs = 1
+        self.total = jobs
+        self.slotdir = self._slotdir(slotdir or slot_dir)
+        # slot number -> locked fd, for the slots held by this process
+        self.held = dict()
+        self.lock = threading.Lock()
+        # Seconds between attempts to lock a slot when all are busy
+        self.poll_interval = 1
+        self.start = time.time()
+        # List of (name, cores, elapsed) tuples, one per completed build
+        self.usage = list()
+        self.peak = 0
+
+        self.jobserver_fds = None
+        if jobserver:
+            self._start_jobserver()
+
+    def _slotdir(self, path):
+        '''Create the slot directory, falling back to a temporary directory
+        when it can't be written (e.g. when not running as root)'''
+        for d in [path, os.path.join(tempfile.gettempdir(), 'aeolus-helper-cpu')]:
+            try:
+                os.makedirs(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    continue
+            if os.access(d, os.W_OK):
+                if d != path:
+                    logging.warn("Unable to write %s, sharing the CPU " % path \
+                        + "budget through %s" % d)
+                return d
+        raise Exception("No writable directory for the CPU budget")
+
+    def _lock_slots(self, want):
+        '''Lock up to want free slots, returning their numbers'''
+        got = list()
+        self.lock.acquire()
+        try:
+            for slot in xrange(self.total):
+                if len(got) >= want:
+                    break
+                if slot in self.held:
+                    continue
+                fd = os.open(os.path.join(self.slotdir, 'slot.%d' % slot),
+                    os.O_RDWR | os.O_CREAT, 0666)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError, e:
+                    # Held by another build
+                    os.close(fd)
+                    continue
+                self.held[slot] = fd
+                got.append(slot)
+            self.peak = max(self.peak, len(self.held))
+        finally:
+            self.lock.release()
+        return got
+
+    def _start_jobserver(self):
+        '''Create the (initially empty) jobserver pipe'''
+        self.jobserver_fds = os.pipe()
+        logging.debug("Started jobserver on fds %d,%d" % self.jobserver_fds)
+
+    def _add_tokens(self, count):
+        if self.jobserver_fds is not None and count > 0:
+            os.write(self.jobserver_fds[1], '+' * count)
+
+    def _remove_tokens(self, count):
+        '''Take back tokens, waiting for any still held by running makes'''
+        while self.jobserver_fds is not None and count > 0:
+            count -= len(os.read(self.jobserver_fds[0], count))
+
+    def close(self):
+        if self.jobserver_fds is not None:
+            for fd in self.jobserver_fds:
+                os.close(fd)
+            self.jobserver_fds = None
+
+    def acquire(self, want=None):
+        '''Block until at least one core is free on the host, then return
+        the list of slots granted (at most want, default: all)'''
+        if want is None or want > self.total:
+            want = self.total
+        want = max(1, want)
+
+        slots = self._lock_slots(want)
+        if len(slots) == 0:
+            logging.info("Waiting for a free core (all %d in use on this host)" \
+                % self.total)
+        while len(slots) == 0:
+            time.sleep(self.poll_interval)
+            slots = self._lock_slots(want)
+        return slots
+
+    def release(self, slots):
+        self.lock.acquire()
+        try:
+            for slot in slots:
+                fd = self.held.pop(slot)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        finally:
+            self.lock.release()
+
+    def environ(self, cores):
+        '''Return the environment variables instructing a build to use the
+        provided number of cores'''
+        if self.jobserver_fds is not None:
+            # An explicit -jN would make each make ignore the shared pool, so
+            # keep %_smp_mflags empty (it only expands when NCPUS > 1)
+            return {'RPM_BUILD_NCPUS': '1',
+                    'MAKEFLAGS': '-j --jobserver-fds=%d,%d' % self.jobserver_fds}
+        return {'RPM_BUILD_NCPUS': str(cores), 'MAKEFLAGS': '-j%d' % cores}
+
+    @contextmanager
+    def allocate(self, name, want=None):
+        '''Reserve cores for the duration of a build, yielding the
+        environment to run it with'''
+        slots = self.acquire(want)
+        cores = len(slots)
+        logging.debug("Allocated %d of %d cores to %s" % \
+            (cores, self.total, name))
+        start = time.time()
+        self._add_tokens(cores - 1)
+        try:
+            yield self.environ(cores)
+        finally:
+            self._remove_tokens(cores - 1)
+            self.release(slots)
+            self.lock.acquire()
+            try:
+                self.usage.append((name, cores, time.time() - start))
+            finally:
+                self.lock.release()
+
+    def reset(self):
+        '''Forget the usage recorded so far'''
+        self.lock.acquire()
+        try:
+            self.usage = list()
+            self.peak = len(self.held)
+            self.start = time.time()
+        finally:
+            self.lock.release()
+
+    def report(self):
+        '''Log the cores used by each build and the overall utilization'''
+        if len(self.usage) == 0:
+            return
+
+        wall = time.time() - self.start
+        logging.info("CPU budget: %d cores%s" % (self.total,
+            self.jobserver_fds is not None and ' (jobserver)' or ''))
+        for (name, cores, elapsed) in self.usage:
+            logging.info("... %s: %d cores for %.1fs" % (name, cores, elapsed))
+        allocated = sum([cores * elapsed for (name, cores, elapsed) in self.usage])
+        if wall > 0:
+            logging.info("Allocated %.1f of %.1f core-seconds (%.0f%%), " \
+                % (allocated, self.total * wall,
+                   100.0 * allocated / (self.total * wall)) \
+                + "peak %d cores in use by this run" % self.peak)
@@ -0,0 +1,577 @@
+#
+# Parse dependencies out of RPM .spec files
+#
+# Copyright (C) 2011  Red Hat
+# James Laska <jlaska@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import sys
+import time
+import logging
+import subprocess
+
+dep_types = ['BuildRequires', 'Requires']
+
+# Sections after which no more preamble tags are expected
+script_sections = ['description', 'prep', 'build', 'install', 'check',
+    'clean', 'files', 'pre', 'post', 'preun', 'postun', 'pretrans',
+    'posttrans', 'verifyscript', 'triggerin', 'triggerun', 'triggerpostun',
+    'triggerprein']
+
+tag_re = re.compile(r'^([A-Za-z]+)(\([^)]*\))?\s*:\s*(.*)$', re.DOTALL)
+macro_name_re = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+version_op_re = re.compile(r'\s*(<=|>=|==|<|>|=)\s*')
+
+_host_dist = None
+
+def host_dist():
+    '''Return the %{dist} of the running system (e.g. '.fc16')'''
+    global _host_dist
+    if _host_dist is None:
+        try:
+            p = subprocess.Popen(['rpm', '--eval', '%{?dist}'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _host_dist = p.communicate()[0].strip()
+        except OSError:
+            _host_dist = ''
+    return _host_dist
+
+def target_macros(dist=None, arch=None):
+    '''Return the macros describing a build target.  The dist (e.g. '.el6')
+    and arch (e.g. 'x86_64') default to those of the running system; rpm is
+    only queried when no dist is provided.'''
+    if dist is None:
+        dist = host_dist()
+    if arch is None:
+        arch = os.uname()[4]
+    if dist != '' and not dist.startswith('.'):
+        dist = '.' + dist
+
+    libdir = arch in ['x86_64', 'ppc64', 's390x'] and '/usr/lib64' or '/usr/lib'
+    macros = {
+        'dist': dist,
+        '_arch': arch,
+        '_target_cpu': arch,
+        '_build_arch': arch,
+        '_target_os': 'linux',
+        'ix86': 'i386 i486 i586 i686 athlon',
+        'x86_64': 'x86_64 amd64 em64t',
+        '_prefix': '/usr',
+        '_exec_prefix': '/usr',
+        '_bindir': '/usr/bin',
+        '_sbindir': '/usr/sbin',
+        '_libdir': libdir,
+        '_libexecdir': '/usr/libexec',
+        '_datadir': '/usr/share',
+        '_mandir': '/usr/share/man',
+        '_docdir': '/usr/share/doc',
+        '_includedir': '/usr/include',
+        '_sysconfdir': '/etc',
+        '_localstatedir': '/var',
+        '_sharedstatedir': '/var/lib',
+        '_initrddir': '/etc/rc.d/init.d',
+        '_initddir': '/etc/rc.d/init.d',
+    }
+    m = re.match(r'^\.fc(\d+)', dist)
+    if m:
+        macros['fedora'] = m.group(1)
+    m = re.match(r'^\.el(\d+)', dist)
+    if m:
+        macros['rhel'] = m.group(1)
+        macros['el%s' % m.group(1)] = '1'
+    return macros
+
+def normalize_deps(text):
+    '''Split the value of a dependency tag into a list of dependencies of
+    the form 'name' or 'name op version'.  Tokens that cannot be a package
+    name (unexpanded macros, autoconf @VARS@, empty strings) are dropped.'''
+    # Collapse shell expansions, which may contain spaces, into one token
+    start = text.find('%(')
+    while start >= 0:
+        level = 0
+        for end in xrange(start + 1, len(text)):
+            level += {'(': 1, ')': -1}.get(text[end], 0)
+            if level == 0:
+                break
+        text = text[:start] + '%()' + text[end + 1:]
+        start = text.find('%(', start + 3)
+
+    tokens = version_op_re.sub(lambda m: ' %s ' % m.group(1),
+        text.replace(',', ' ')).split()
+
+    deps = list()
+    i = 0
+    while i < len(tokens):
+        name = tokens[i]
+        i += 1
+        version = None
+        if i < len(tokens) and tokens[i] in ['<', '>', '<=', '>=', '=', '==']:
+            op = tokens[i] == '==' and '=' or tokens[i]
+            if i + 1 < len(tokens):
+                version = '%s %s' % (op, tokens[i + 1])
+            i += 2
+
+        if '%' in name or '@' in name or name.startswith('('):
+            logging.debug("Ignoring unparseable dependency: %s" % name)
+            continue
+        # Keep the name when only the version couldn't be expanded
+        if version is not None and ('%' in version or '@' in version):
+            logging.debug("Ignoring unparseable version: %s %s" % \
+                (name, version))
+            version = None
+        deps.append(version is None and name or '%s %s' % (name, version))
+    return deps
+
+def unique(items):
+    '''Remove duplicates, preserving order'''
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
+
+class SpecFile(object):
+    '''Single-pass parser for the dependency tags of a .spec file.
+
+    Macros (%global, %define, %{?name:...}, %{!?name:...}, %bcond_with),
+    conditionals (%if, %elif, %else, %ifarch, %ifnarch, %ifos, %ifnos) and
+    backslash-continued lines are evaluated for the target described by
+    `macros` (see target_macros()).  Dependencies are recorded for each
+    (sub-)package in self.packages.
+    '''
+
+    max_depth = 32
+
+    def __init__(self, path, macros=None, text=None):
+        self.path = path
+        # The target's macros replace (rather than extend) the host's, and
+        # are copied since parsing defines more of them
+        if macros is None:
+            macros = target_macros()
+        self.macros = dict(macros)
+        self.name = None
+        # package name -> {deptype: [deps]}, in order of appearance
+        self.packages = dict()
+        self.package_order = list()
+
+        if text is None:
+            fd = open(path, 'r')
+            try:
+                text = fd.read()
+            finally:
+                fd.close()
+        self._parse(text)
+
+    def dependencies(self, deptype, package=None):
+        '''Return the normalized, deduplicated list of deps of the provided
+        type for one package (default: all packages).  Deps on packages built
+        by this .spec are left out.'''
+        assert deptype in dep_types, \
+            "Unknown dependency type requested: %s" % deptype
+        if package is not None:
+            deps = self.packages.get(package, {}).get(deptype, [])
+        else:
+            deps = list()
+            for pkg in self.package_order:
+                deps += self.packages[pkg][deptype]
+        return unique([d for d in deps \
+                       if d.split()[0] not in self.packages])
+
+    # Macro expansion ==========================================================
+
+    def is_defined(self, name):
+        return name in self.macros
+
+    def expand(self, text, depth=0):
+        '''Expand any macros in text.  Undefined macros are left in place.'''
+        if '%' not in text:
+            return text
+        if depth > self.max_depth:
+            raise Exception("%s: macro recursion too deep: %s" % \
+                (self.path, text))
+
+        out = list()
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if c != '%' or i + 1 >= n:
+                # Copy everything up to the next macro in one go
+                j = text.find('%', i + 1)
+                if j < 0:
+                    j = n
+                out.append(text[i:j])
+                i = j
+                continue
+
+            nxt = text[i + 1]
+            if nxt == '%':
+                out.append('%')
+                i += 2
+            elif nxt == '{':
+                end = self._matching(text, i + 1, '{', '}')
+                if end < 0:
+                    out.append(text[i:])
+                    break
+                out.append(self._expand_braced(text[i + 2:end], text[i:end + 1],
+                    depth))
+                i = end + 1
+            elif nxt == '(':
+                # Shell expansion is never run, leave it for the caller to drop
+                end = self._matching(text, i + 1, '(', ')')
+                if end < 0:
+                    end = n - 1
+                out.append(text[i:end + 1])
+                i = end + 1
+            else:
+                m = macro_name_re.match(text, i + 1)
+                if m is None:
+                    out.append('%')
+                    i += 1
+                    continue
+                name = m.group(0)
+                if name in self.macros:
+                    out.append(self.expand(self.macros[name], depth + 1))
+                else:
+                    out.append(text[i:m.end()])
+                i = m.end()
+        return ''.join(out)
+
+    def _matching(self, text, start, opening, closing):
+        '''Return the index of the bracket closing the one at text[start]'''
+        level = 0
+        for i in xrange(start, len(text)):
+            if text[i] == opening:
+                level += 1
+            elif text[i] == closing:
+                level -= 1
+                if level == 0:
+                    return i
+        return -1
+
+    def _expand_braced(self, body, literal, depth):
+        '''Expand the contents of a %{...} macro'''
+        # %{?name}, %{!?name}, %{?name:text}, %{!?name:text}
+        negate = False
+        conditional = False
+        while body[:1] in ['!', '?']:
+            if body[0] == '!':
+                negate = not negate
+            else:
+                conditional = True
+            body = body[1:]
+
+        if ':' in body:
+            (name, arg) = body.split(':', 1)
+        elif ' ' in body:
+            (name, arg) = body.split(' ', 1)
+        else:
+            (name, arg) = (body, None)
+
+        if conditional:
+            defined = self.is_defined(name)
+            if negate:
+                return (not defined and arg is not None) and \
+                    self.expand(arg, depth + 1) or ''
+            if not defined:
+                return ''
+            if arg is not None:
+                return self.expand(arg, depth + 1)
+            return self.expand(self.macros[name], depth + 1)
+
+        if name == 'expand' and arg is not None:
+            return self.expand(self.expand(arg, depth + 1), depth + 1)
+        if name in ['with', 'without'] and arg is not None:
+            defined = self.is_defined('with_%s' % arg.strip())
+            return (defined == (name == 'with')) and '1' or '0'
+        if name in self.macros and arg is None:
+            return self.expand(self.macros[name], depth + 1)
+        return literal
+
+    # Conditionals =============================================================
+
+    def evaluate(self, expr):
+        '''Evaluate the (already expanded) expression of an %if'''
+        tokens = re.findall(r'"[^"]*"|&&|\|\||==|!=|<=|>=|[<>()!]|[^\s<>=!&|()"]+',
+            expr)
+        if len(tokens) == 0:
+            return False
+        (value, pos) = self._eval_or(tokens, 0)
+        if pos != len(tokens):
+            raise Exception("%s: unable to evaluate: %s" % (self.path, expr))
+        return bool(value)
+
+    def _eval_or(self, tokens, pos):
+        (value, pos) = self._eval_and(tokens, pos)
+        while pos < len(tokens) and tokens[pos] == '||':
+            (rhs, pos) = self._eval_and(tokens, pos + 1)
+            value = value or rhs
+        return (value, pos)
+
+    def _eval_and(self, tokens, pos):
+        (value, pos) = self._eval_cmp(tokens, pos)
+        while pos < len(tokens) and tokens[pos] == '&&':
+            (rhs, pos) = self._eval_cmp(tokens, pos + 1)
+            value = value and rhs
+        return (value, pos)
+
+    def _eval_cmp(self, tokens, pos):
+        (value, pos) = self._eval_unary(tokens, pos)
+        ops = {'==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+               '<': lambda a, b: a < b, '>': lambda a, b: a > b,
+               '<=': lambda a, b: a <= b, '>=': lambda a, b: a >= b}
+        while pos < len(tokens) and tokens[pos] in ops:
+            op = tokens[pos]
+            (rhs, pos) = self._eval_unary(tokens, pos + 1)
+            value = ops[op](value, rhs)
+        return (value, pos)
+
+    def _eval_unary(self, tokens, pos):
+        if pos >= len(tokens):
+            raise Exception("%s: truncated expression" % self.path)
+        tok = tokens[pos]
+        if tok == '!':
+            (value, pos) = self._eval_unary(tokens, pos + 1)
+            return (not value, pos)
+        if tok == '(':
+            (value, pos) = self._eval_or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise Exception("%s: unbalanced parenthesis" % self.path)
+            return (value, pos + 1)
+        if tok.startswith('"'):
+            return (tok[1:-1], pos + 1)
+        try:
+            return (int(tok), pos + 1)
+        except ValueError:
+            # Like rpm, treat anything else (e.g. an undefined macro) as a
+            # string
+            return (tok, pos + 1)
+
+    def _eval_directive(self, directive, arg):
+        '''Return whether the provided %if* directive holds'''
+        if directive in ['if', 'elif']:
+            return self.evaluate(self.expand(arg))
+        values = self.expand(arg).replace(',', ' ').split()
+        if directive in ['ifarch', 'ifnarch']:
+            current = self.macros.get('_target_cpu')
+        else:
+            current = self.macros.get('_target_os')
+        return (current in values) == (directive in ['ifarch', 'ifos'])
+
+    # Parsing ==================================================================
+
+    def _define(self, line, expand_now):
+        parts = line.split(None, 2)
+        if len(parts) < 2:
+            return
+        # Drop any macro options, e.g. %define foo(a:) ...
+        name = re.sub(r'\(.*$', '', parts[1])
+        body = len(parts) > 2 and parts[2].strip() or ''
+        if expand_now:
+            body = self.expand(body)
+        self.macros[name] = body
+
+    def _start_package(self, arg):
+        '''Return the name of the sub-package declared by %package'''
+        args = self.expand(arg).split()
+        if '-n' in args:
+            idx = args.index('-n')
+            if idx + 1 < len(args):
+                return args[idx + 1]
+        args = [a for a in args if not a.startswith('-')]
+        if len(args) == 0:
+            return self.name
+        return '%s-%s' % (self.name, args[0])
+
+    def _add_package(self, name):
+        if name not in self.packages:
+            self.packages[name] = dict((t, list()) for t in dep_types)
+            self.package_order.append(name)
+
+    def _parse(self, text):
+        # Each entry is (enclosing block active, this branch active, a branch
+        # was already taken)
+        stack = list()
+        active = True
+        package = None      # None until Name: is seen
+        in_preamble = True
+        pending = list()    # tags seen before Name:
+
+        lines = text.split('\n')
+        i = 0
+        nlines = len(lines)
+        while i < nlines:
+            line = lines[i]
+            i += 1
+            # Join continuation lines
+            while line.endswith('\\') and i < nlines:
+                line = line[:-1] + '\n' + lines[i]
+                i += 1
+
+            stripped = line.strip()
+            if stripped == '':
+                continue
+
+            if stripped[0] == '%':
+                m = macro_name_re.match(stripped, 1)
+                directive = m and m.group(0) or ''
+                arg = m and stripped[m.end():].strip() or ''
+
+                # Conditionals are tracked even within inactive blocks
+                if directive in ['if', 'ifarch', 'ifnarch', 'ifos', 'ifnos']:
+                    taken = active and self._eval_directive(directive, arg)
+                    stack.append((active, taken, taken))
+                    active = taken
+                    continue
+                if directive == 'elif' and len(stack) > 0:
+                    (outer, current, done) = stack.pop()
+                    taken = outer and not done and \
+                        self._eval_directive('if', arg)
+                    stack.append((outer, taken, done or taken))
+                    active = taken
+                    continue
+                if directive == 'else' and len(stack) > 0:
+                    (outer, current, done) = stack.pop()
+                    taken = outer and not done
+                    stack.append((outer, taken, True))
+                    active = taken
+                    continue
+                if directive == 'endif' and len(stack) > 0:
+                    (outer, current, done) = stack.pop()
+                    active = outer
+                    continue
+
+                if not active:
+                    continue
+
+                # Handle the %{!?foo: %global foo ...} idiom
+                if directive == '' and stripped.startswith('%{'):
+                    stripped = self.expand(stripped).strip()
+                    if stripped == '':
+                        continue
+                    m = macro_name_re.match(stripped, 1)
+                    directive = m and m.group(0) or ''
+                    arg = m and stripped[m.end():].strip() or ''
+
+                if directive in ['global', 'define']:
+                    self._define(stripped, directive == 'global')
+                    continue
+                if directive == 'undefine':
+                    self.macros.pop(arg.strip(), None)
+                    continue
+                if directive in ['bcond_with', 'bcond_without']:
+                    # %bcond_without foo builds with foo unless told otherwise
+                    opt = arg.strip()
+                    if directive == 'bcond_without' and \
+                       not self.is_defined('_without_%s' % opt):
+                        self.macros['with_%s' % opt] = '1'
+                    elif directive == 'bcond_with' and \
+                       self.is_defined('_with_%s' % opt):
+                        self.macros['with_%s' % opt] = '1'
+                    continue
+                if directive == 'package':
+                    package = self._start_package(arg)
+                    self._add_package(package)
+                    in_preamble = True
+                    continue
+                if directive == 'changelog':
+                    break
+                if directive in script_sections:
+                    in_preamble = False
+                    continue
+
+            if not active or not in_preamble or stripped[0] == '#':
+                continue
+
+            m = tag_re.match(stripped)
+            if m is None:
+                continue
+            tag = m.group(1).lower()
+            value = m.group(3)
+
+            if tag in ['name', 'version', 'release', 'epoch']:
+                # Only the main package defines %{name}, %{version}, ...
+                if package is None or package == self.name:
+                    value = self.expand(value).strip()
+                    self.macros[tag] = value
+                if tag == 'name' and package is None:
+                    self.name = package = value
+                    self._add_package(package)
+                    for (t, v) in pending:
+                        self.packages[package][t] += \
+                            normalize_deps(self.expand(v))
+                continue
+
+            for deptype in dep_types:
+                if tag == deptype.lower():
+                    if package is None:
+                        pending.append((deptype, value))
+                    else:
+                        self.packages[package][deptype] += \
+                            normalize_deps(self.expand(value))
+
+        # Keep the deps of a .spec lacking a Name:
+        if package is None and len(pending) > 0:
+            self.name = os.path.basename(self.path)
+            self._add_package(self.name)
+            for (t, v) in pending:
+                self.packages[self.name][t] += normalize_deps(self.expand(v))
+
+def parse_specs(specfiles, deptype, macros=None):
+    '''Return the normalized, deduplicated deps of the provided type from a
+    list of .spec files'''
+    deps = list()
+    for spec in specfiles:
+        try:
+            parsed = SpecFile(spec, macros)
+        except Exception, e:
+            logging.warn("Unable to parse %s: %s" % (spec, e))
+            continue
+        for pkg in parsed.package_order:
+            logging.debug("%s [%s] %s: %s" % (os.path.basename(spec), pkg,
+                deptype, ', '.join(parsed.dependencies(deptype, pkg))))
+        deps += parsed.dependencies(deptype)
+    return unique(deps)
+
+if __name__ == "__main__":
+    # Report per-package deps and parse time, e.g.
+    #   python aeoluslib/specfile.py --dist=.el6 katello/katello.spec
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] <spec> [spec...]')
+    parser.add_option("--dist", action="store", default=None,
+        help="Target %{dist} (default: that of this host)")
+    parser.add_option("--arch", action="store", default=None,
+        help="Target architecture (default: that of this host)")
+    parser.add_option("-n", "--iterations", action="store", type="int",
+        default=100, help="Times to parse each spec (default: %default)")
+    (opts, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.error("No .spec file provided")
+
+    macros = target_macros(opts.dist, opts.arch)
+    for spec in args:
+        text = open(spec, 'r').read()
+        start = time.time()
+        for n in xrange(opts.iterations):
+            parsed = SpecFile(spec, macros, text)
+        elapsed = (time.time() - start) / opts.iterations
+        print "%s: %d lines, %.2f ms per parse" % (spec, text.count('\n'),
+            elapsed * 1000)
+        for pkg in parsed.package_order:
+            for deptype in dep_types:
+                deps = parsed.dependencies(deptype, pkg)
+                if len(deps) > 0:
+                    print "  %s %s: %s" % (pkg, deptype, ', '.join(deps))
+    sys.exit(0)
@@ -0,0 +1,207 @@
+#
+# Rebuild aeolus modules whenever their upstream branch changes
+#
+# Copyright (C) 2011  Red Hat
+# James Laska <jlaska@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import time
+import json
+import logging
+
+import aeoluslib
+from aeoluslib.cli import find_module
+
+class Watcher(object):
+    '''Poll the branch head of each watched module and rebuild the modules
+    whose head moved, along with every watched module depending on them.
+
+    A change is only built once its head has been stable for `debounce`
+    seconds, so a burst of commits results in a single build.  The last
+    built commit of each module is kept in `statefile` across restarts.
+    '''
+
+    def __init__(self, modules, statefile, interval=300, debounce=60,
+                 branch='master'):
+        self.modules = dict()
+        # Instances used only to query branch heads
+        self.remotes = dict()
+        for name in modules:
+            cls_obj = find_module(name)
+            if cls_obj is None:
+                raise Exception("Unable to find aeoluslib module for %s" % name)
+            self.modules[name] = cls_obj
+            self.remotes[name] = cls_obj()
+        self.order = list(modules)
+        self.statefile = statefile
+        self.interval = interval
+        self.debounce = debounce
+        self.branch = branch
+
+        # module -> last built commit
+        self.built = self._load_state()
+        # module -> (head, time the head was first seen)
+        self.pending = dict()
+        # module -> head that failed to build
+        self.failed = dict()
+
+    def _load_state(self):
+        if os.path.isfile(self.statefile):
+            fd = open(self.statefile, 'r')
+            try:
+                return json.load(fd)
+            finally:
+                fd.close()
+        return dict()
+
+    def _save_state(self):
+        aeoluslib.makedirs(os.path.dirname(os.path.abspath(self.statefile)))
+        tmpfile = self.statefile + '.tmp'
+        fd = open(tmpfile, 'w')
+        try:
+            json.dump(self.built, fd, indent=2, sort_keys=True)
+        finally:
+            fd.close()
+        os.rename(tmpfile, self.statefile)
+
+    def poll(self, now=None):
+        '''Query each module's branch head and record any change'''
+        if now is None:
+            now = time.time()
+        for name in self.order:
+            # A single unreachable repository mustn't stop the daemon
+            try:
+                head = self.remotes[name].get_remote_hash(self.branch)
+            except Exception, e:
+                logging.error("Unable to query %s (%s): %s" % (name,
+                    self.branch, e))
+                continue
+            if head is None or not re.match(r'^[0-9a-f]{40}$', head):
+                logging.warn("No %s head found for %s, skipping" % \
+                    (self.branch, name))
+                self.pending.pop(name, None)
+                continue
+            if head in [self.built.get(name), self.failed.get(name)]:
+                self.pending.pop(name, None)
+                continue
+            # A new head restarts the debounce period
+            if self.pending.get(name, (None, 0))[0] != head:
+                logging.info("%s (%s) changed: %s -> %s" % (name, self.branch,
+                    self.built.get(name, 'never built'), head))
+                self.pending[name] = (head, now)
+
+    def ready(self, now=None):
+        '''Return the changed modules whose head has settled'''
+        if now is None:
+            now = time.time()
+        return [name for name in self.order if name in self.pending \
+                and now - self.pending[name][1] >= self.debounce]
+
+    def dependents(self, names):
+        '''Return the provided modules and every watched module depending on
+        them (directly or not), in build order'''
+        deps = dict((name, self.remotes[name].depends_on) \
+            for name in self.order)
+
+        selected = set(names)
+        grown = True
+        while grown:
+            grown = False
+            for name in self.order:
+                if name not in selected and selected.intersection(deps[name]):
+                    selected.add(name)
+                    grown = True
+
+        # Order so that each module is built after its dependencies
+        ordered = list()
+        while len(ordered) < len(selected):
+            progress = False
+            for name in self.order:
+                if name in selected and name not in ordered and not \
+                   [d for d in deps[name] if d in selected and d not in ordered]:
+                    ordered.append(name)
+                    progress = True
+            if not progress:
+                raise Exception("Circular module dependencies: %s" % \
+                    ', '.join([n for n in selected if n not in ordered]))
+        return ordered
+
+    def _build(self, name, changed):
+        '''Build a single module, returning the commit built'''
+        cls_inst = self.modules[name]()
+        targets = None
+        # Only rebuild the sub-targets touched since the last build
+        last = self.built.get(name)
+        if changed and last is not None and len(cls_inst.build_targets) > 0:
+            cls_inst._clone_from_scm()
+            try:
+                targets = cls_inst.changed_build_targets(last) or None
+            except Exception, e:
+                logging.warn("Unable to compare %s with %s: %s" % \
+                    (name, last, e))
+        cls_inst.build_from_scm(targets)
+        return cls_inst.get_local_hash()
+
+    def run_once(self, now=None):
+        '''Poll once and build any settled changes'''
+        self.poll(now)
+        changed = self.ready(now)
+        if len(changed) == 0:
+            return list()
+
+        queue = self.dependents(changed)
+        logging.info("Rebuilding: %s" % ', '.join(queue))
+        # Report the CPU usage of each cycle separately
+        budget = aeoluslib.get_cpu_budget()
+        budget.reset()
+        try:
+            self._rebuild(queue, changed)
+        finally:
+            budget.report()
+        return queue
+
+    def _rebuild(self, queue, changed):
+        '''Build the queued modules in order, recording the commits built'''
+        broken = list()
+        for name in queue:
+            head = self.pending.pop(name, (None, 0))[0]
+            blockers = [d for d in self.remotes[name].depends_on if d in broken]
+            if len(blockers) > 0:
+                logging.error("Skipping %s, dependencies failed to build: %s" \
+                    % (name, ', '.join(blockers)))
+                broken.append(name)
+                continue
+            try:
+                self.built[name] = self._build(name, name in changed)
+                self.failed.pop(name, None)
+            except Exception, e:
+                logging.error("Failed to build %s: %s" % (name, e))
+                broken.append(name)
+                if head is not None:
+                    self.failed[name] = head
+            self._save_state()
+
+    def run(self):
+        logging.info("Watching %s every %ss" % (', '.join(self.order),
+            self.interval))
+        while True:
+            try:
+                self.run_once()
+            except Exception, e:
+                logging.error("Watch cycle failed: %s" % e)
+            time.sleep(self.interval)